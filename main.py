@@ -3,13 +3,15 @@
 
 from fastapi import FastAPI, Depends, HTTPException, status
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy import create_engine, Column, Integer, String, ForeignKey, DateTime, Text, Enum as PyEnum
-from sqlalchemy.orm import sessionmaker, Session, relationship
+from fastapi.responses import StreamingResponse
+from sqlalchemy import create_engine, Column, Integer, String, ForeignKey, DateTime, Text, Enum as PyEnum, text
+from sqlalchemy.orm import sessionmaker, Session, relationship, joinedload
 from sqlalchemy.orm import declarative_base 
 from pydantic import BaseModel, ConfigDict
 from typing import List, Optional
 from datetime import datetime, date
 import os
+import json
 from dateutil.rrule import rrule, rrulestr, rrulebase
 from dateutil.relativedelta import relativedelta
 import datetime as dt
@@ -68,6 +70,14 @@ class Evolucao(Base):
     agendamento = relationship("Agendamento", back_populates="evolucao")
     paciente = relationship("Paciente", back_populates="evolucoes")
 
+class Alteracao(Base):
+    # Log de alterações para a sincronização incremental (/sync): o id é a versão
+    __tablename__ = 'alteracoes'
+    id = Column(Integer, primary_key=True, index=True)
+    entidade = Column(String, nullable=False)  # 'paciente', 'agendamento' ou 'evolucao'
+    entidade_id = Column(Integer, nullable=False)
+    operacao = Column(String, nullable=False)  # 'upsert' ou 'delete'
+
 # Cria as tabelas
 Base.metadata.create_all(bind=engine)
 
@@ -121,6 +131,21 @@ class OcorrenciaStatus(BaseModel):
     data_ocorrencia: datetime
     novo_status: str
 
+class ItemStatusLote(BaseModel):
+    agendamento_id: int
+    data_ocorrencia: Optional[datetime] = None  # Preenchido = ocorrência virtual de uma regra
+    novo_status: str
+
+class StatusLote(BaseModel):
+    itens: List[ItemStatusLote]
+
+class ResultadoItemLote(BaseModel):
+    agendamento_id: int
+    data_ocorrencia: Optional[datetime] = None
+    sucesso: bool
+    detail: Optional[str] = None
+    agendamento: Optional[AgendamentoSchema] = None
+
 class DashboardSessao(BaseModel):
     nome_paciente: str
     total_sessoes: int
@@ -131,6 +156,20 @@ class EvolucaoSchema(BaseModel):
     data_criacao: datetime
     model_config = ConfigDict(from_attributes=True)
 
+class AgendamentoSyncSchema(BaseModel):
+    id: int
+    paciente_id: int
+    data_hora_inicio: datetime
+    data_hora_fim: datetime
+    status: str
+    rrule: Optional[str] = None
+    exdates: Optional[str] = None
+    model_config = ConfigDict(from_attributes=True)
+
+class EvolucaoSyncSchema(EvolucaoSchema):
+    agendamento_id: int
+    paciente_id: int
+
 # --- 4. INICIALIZAÇÃO DO APP E CORS ---
 
 app = FastAPI(title="Minha Agenda API")
@@ -152,6 +191,26 @@ def get_db():
     finally:
         db.close()
 
+# Chave arbitrária do advisory lock que serializa as escritas no log de alterações
+LOCK_ALTERACOES = 8420271
+
+def travar_alteracoes(db: Session):
+    # O id do log é a versão do /sync, então ele tem que ser atribuído na ordem dos commits:
+    # sem isso, a transação A pega o id 10, a B pega o 11 e commita antes, e um cliente que
+    # sincronizar nesse meio tempo pula o 10 para sempre. No Postgres, pg_advisory_xact_lock
+    # faz as transações que escrevem no log passarem uma de cada vez (o lock vale até o
+    # commit/rollback e pode ser pedido de novo na mesma transação). No SQLite a escrita já
+    # é serializada pelo lock do próprio banco.
+    # Toda rota que altera dados chama isto no início, antes de qualquer escrita (flush ou
+    # commit): pedir o lock depois, já segurando locks de linha, abre espaço para deadlock.
+    if engine.dialect.name == 'postgresql':
+        db.execute(text("SELECT pg_advisory_xact_lock(:chave)"), {"chave": LOCK_ALTERACOES})
+
+def registrar_alteracao(db: Session, entidade: str, entidade_id: int, operacao: str = 'upsert'):
+    # Entra na mesma transação da alteração, que já deve ter chamado travar_alteracoes.
+    # O id do registro precisa existir: em criações, chame db.flush() antes.
+    db.add(Alteracao(entidade=entidade, entidade_id=entidade_id, operacao=operacao))
+
 
 # --- 6. ROTAS ---
 
@@ -159,6 +218,7 @@ def get_db():
 
 @app.post("/pacientes", response_model=PacienteSchema, status_code=status.HTTP_201_CREATED)
 def criar_paciente(paciente: PacienteCreate, db: Session = Depends(get_db)):
+    travar_alteracoes(db)
     data_nasc = datetime.combine(paciente.data_nascimento, datetime.min.time()) if paciente.data_nascimento else None
     
     # [CORRIGIDO] Removemos data_nascimento do model_dump() antes de passá-lo
@@ -169,6 +229,8 @@ def criar_paciente(paciente: PacienteCreate, db: Session = Depends(get_db)):
         data_nascimento=data_nasc
     )
     db.add(db_paciente)
+    db.flush()
+    registrar_alteracao(db, 'paciente', db_paciente.id)
     db.commit()
     db.refresh(db_paciente)
     return db_paciente
@@ -180,6 +242,7 @@ def listar_pacientes(db: Session = Depends(get_db)):
 
 @app.patch("/pacientes/{paciente_id}", response_model=PacienteSchema)
 def atualizar_paciente(paciente_id: int, paciente: PacienteCreate, db: Session = Depends(get_db)):
+    travar_alteracoes(db)
     db_paciente = db.query(Paciente).filter(Paciente.id == paciente_id).first() 
     if db_paciente is None:
         raise HTTPException(status_code=404, detail="Paciente not found")
@@ -196,17 +259,25 @@ def atualizar_paciente(paciente_id: int, paciente: PacienteCreate, db: Session =
     for key, value in dados_paciente.items():
         setattr(db_paciente, key, value)
     
+    registrar_alteracao(db, 'paciente', db_paciente.id)
     db.commit()
     db.refresh(db_paciente)
     return db_paciente
 
 @app.delete("/pacientes/{paciente_id}", status_code=status.HTTP_200_OK)
 def deletar_paciente(paciente_id: int, db: Session = Depends(get_db)):
+    travar_alteracoes(db)
     db_paciente = db.query(Paciente).filter(Paciente.id == paciente_id).first() 
     if db_paciente is None:
         raise HTTPException(status_code=404, detail="Paciente not found")
     
     try:
+        # Agendamentos e evoluções saem junto (cascade), então também vão para o log
+        for db_agendamento in db_paciente.agendamentos:
+            registrar_alteracao(db, 'agendamento', db_agendamento.id, 'delete')
+        for db_evolucao in db_paciente.evolucoes:
+            registrar_alteracao(db, 'evolucao', db_evolucao.id, 'delete')
+        registrar_alteracao(db, 'paciente', db_paciente.id, 'delete')
         db.delete(db_paciente)
         db.commit()
     except Exception as e:
@@ -278,6 +349,7 @@ def listar_agendamentos(start: datetime, end: datetime, db: Session = Depends(ge
 
 @app.post("/agendamentos", response_model=AgendamentoSchema, status_code=status.HTTP_201_CREATED)
 def criar_agendamento(agendamento: AgendamentoCreate, db: Session = Depends(get_db)):
+    travar_alteracoes(db)
     db_paciente = db.query(Paciente).filter(Paciente.id == agendamento.paciente_id).first()
     if db_paciente is None:
         raise HTTPException(status_code=404, detail="Paciente not found")
@@ -290,12 +362,15 @@ def criar_agendamento(agendamento: AgendamentoCreate, db: Session = Depends(get_
         rrule=agendamento.rrule
     )
     db.add(db_agendamento)
+    db.flush()
+    registrar_alteracao(db, 'agendamento', db_agendamento.id)
     db.commit()
     db.refresh(db_agendamento)
     return db_agendamento
 
 @app.patch("/agendamentos/{agendamento_id}", response_model=AgendamentoSchema)
 def atualizar_data_agendamento(agendamento_id: int, update_data: AgendamentoUpdate, db: Session = Depends(get_db)):
+    travar_alteracoes(db)
     db_agendamento = db.query(Agendamento).filter(Agendamento.id == agendamento_id, Agendamento.rrule == None).first()
     if db_agendamento is None:
         raise HTTPException(status_code=404, detail="Agendamento não-recorrente não encontrado")
@@ -304,6 +379,7 @@ def atualizar_data_agendamento(agendamento_id: int, update_data: AgendamentoUpda
         update_data_dict = update_data.model_dump(exclude_unset=True)
         for key, value in update_data_dict.items():
             setattr(db_agendamento, key, value)
+        registrar_alteracao(db, 'agendamento', db_agendamento.id)
         db.commit() 
         db.refresh(db_agendamento)
         return db_agendamento
@@ -313,10 +389,14 @@ def atualizar_data_agendamento(agendamento_id: int, update_data: AgendamentoUpda
 
 @app.delete("/agendamentos/{agendamento_id}", status_code=status.HTTP_200_OK)
 def deletar_agendamento(agendamento_id: int, db: Session = Depends(get_db)):
+    travar_alteracoes(db)
     db_agendamento = db.query(Agendamento).filter(Agendamento.id == agendamento_id).first()
     if db_agendamento is None:
         raise HTTPException(status_code=404, detail="Agendamento not found")
             
+    if db_agendamento.evolucao:
+        registrar_alteracao(db, 'evolucao', db_agendamento.evolucao.id, 'delete')
+    registrar_alteracao(db, 'agendamento', db_agendamento.id, 'delete')
     db.delete(db_agendamento)
     db.commit()
     return {"detail": "Agendamento deletado com sucesso"}
@@ -325,6 +405,7 @@ def deletar_agendamento(agendamento_id: int, db: Session = Depends(get_db)):
 
 @app.post("/agendamentos/{agendamento_id}/mover_ocorrencia", response_model=AgendamentoSchema)
 def mover_ocorrencia(agendamento_id: int, update: OcorrenciaUpdate, db: Session = Depends(get_db)):
+    travar_alteracoes(db)
     regra_pai = db.query(Agendamento).filter(Agendamento.id == agendamento_id).first()
     if regra_pai is None or regra_pai.rrule is None:
         raise HTTPException(status_code=404, detail="Regra de agendamento não encontrada")
@@ -336,8 +417,11 @@ def mover_ocorrencia(agendamento_id: int, update: OcorrenciaUpdate, db: Session
     else:
         regra_pai.exdates = data_excecao_str
     
+    registrar_alteracao(db, 'agendamento', regra_pai.id)
     db.commit()
 
+    travar_alteracoes(db)  # o commit acima soltou o lock
+
     novo_agendamento_unico = Agendamento(
         paciente_id=regra_pai.paciente_id,
         data_hora_inicio=update.novo_inicio,
@@ -346,6 +430,8 @@ def mover_ocorrencia(agendamento_id: int, update: OcorrenciaUpdate, db: Session
         rrule=None
     )
     db.add(novo_agendamento_unico)
+    db.flush()
+    registrar_alteracao(db, 'agendamento', novo_agendamento_unico.id)
     db.commit()
     db.refresh(novo_agendamento_unico)
     
@@ -353,6 +439,7 @@ def mover_ocorrencia(agendamento_id: int, update: OcorrenciaUpdate, db: Session
 
 @app.post("/agendamentos/{agendamento_id}/status_ocorrencia", response_model=AgendamentoSchema)
 def status_ocorrencia(agendamento_id: int, update: OcorrenciaStatus, db: Session = Depends(get_db)):
+    travar_alteracoes(db)
     regra_pai = db.query(Agendamento).filter(Agendamento.id == agendamento_id).first()
     if regra_pai is None or regra_pai.rrule is None:
         raise HTTPException(status_code=404, detail="Regra de agendamento não encontrada")
@@ -364,8 +451,11 @@ def status_ocorrencia(agendamento_id: int, update: OcorrenciaStatus, db: Session
     else:
         regra_pai.exdates = data_excecao_str
     
+    registrar_alteracao(db, 'agendamento', regra_pai.id)
     db.commit()
 
+    travar_alteracoes(db)  # o commit acima soltou o lock
+
     duracao = regra_pai.data_hora_fim - regra_pai.data_hora_inicio
     novo_agendamento_unico = Agendamento(
         paciente_id=regra_pai.paciente_id,
@@ -375,6 +465,8 @@ def status_ocorrencia(agendamento_id: int, update: OcorrenciaStatus, db: Session
         rrule=None
     )
     db.add(novo_agendamento_unico)
+    db.flush()
+    registrar_alteracao(db, 'agendamento', novo_agendamento_unico.id)
     db.commit()
     db.refresh(novo_agendamento_unico)
     
@@ -383,30 +475,128 @@ def status_ocorrencia(agendamento_id: int, update: OcorrenciaStatus, db: Session
 
 @app.post("/agendamentos/{agendamento_id}/checkin", response_model=AgendamentoSchema)
 def fazer_checkin(agendamento_id: int, db: Session = Depends(get_db)):
+    travar_alteracoes(db)
     db_agendamento = db.query(Agendamento).filter(Agendamento.id == agendamento_id, Agendamento.rrule == None).first()
     if db_agendamento is None:
         raise HTTPException(status_code=404, detail="Agendamento não-recorrente não encontrado")
     
     db_agendamento.status = 'Presente'
+    registrar_alteracao(db, 'agendamento', db_agendamento.id)
     db.commit()
     db.refresh(db_agendamento)
     return db_agendamento
 
 @app.post("/agendamentos/{agendamento_id}/cancelar", response_model=AgendamentoSchema)
 def cancelar_atendimento(agendamento_id: int, db: Session = Depends(get_db)):
+    travar_alteracoes(db)
     db_agendamento = db.query(Agendamento).filter(Agendamento.id == agendamento_id, Agendamento.rrule == None).first()
     if db_agendamento is None:
         raise HTTPException(status_code=404, detail="Agendamento não-recorrente não encontrado")
     
     db_agendamento.status = 'Cancelado'
+    registrar_alteracao(db, 'agendamento', db_agendamento.id)
     db.commit()
     db.refresh(db_agendamento)
     return db_agendamento
 
+@app.post("/agendamentos/status_lote", response_model=List[ResultadoItemLote])
+def status_lote(lote: StatusLote, db: Session = Depends(get_db)):
+    # Aplica check-in/cancelamento de vários agendamentos (únicos ou ocorrências de regras)
+    # com uma consulta IN por tipo e um único commit no final.
+    travar_alteracoes(db)
+    ids_unicos = {item.agendamento_id for item in lote.itens if item.data_ocorrencia is None}
+    ids_regras = {item.agendamento_id for item in lote.itens if item.data_ocorrencia is not None}
+
+    unicos = {}
+    if ids_unicos:
+        unicos = {
+            a.id: a for a in db.query(Agendamento).options(joinedload(Agendamento.paciente))
+            .filter(Agendamento.id.in_(ids_unicos), Agendamento.rrule == None).all()
+        }
+    regras = {}
+    if ids_regras:
+        regras = {
+            a.id: a for a in db.query(Agendamento).options(joinedload(Agendamento.paciente))
+            .filter(Agendamento.id.in_(ids_regras), Agendamento.rrule != None).all()
+        }
+
+    resultados = []
+    afetados = []
+    ocorrencias_criadas = {}
+    alterados = set()
+    for item in lote.itens:
+        resultado = ResultadoItemLote(
+            agendamento_id=item.agendamento_id,
+            data_ocorrencia=item.data_ocorrencia,
+            sucesso=False
+        )
+        resultados.append(resultado)
+
+        if item.novo_status not in ('Agendado', 'Presente', 'Cancelado'):
+            resultado.detail = f"Status inválido: {item.novo_status}"
+            continue
+
+        if item.data_ocorrencia is None:
+            db_agendamento = unicos.get(item.agendamento_id)
+            if db_agendamento is None:
+                resultado.detail = "Agendamento não-recorrente não encontrado"
+                continue
+            db_agendamento.status = item.novo_status
+        else:
+            regra_pai = regras.get(item.agendamento_id)
+            if regra_pai is None:
+                resultado.detail = "Regra de agendamento não encontrada"
+                continue
+
+            data_excecao_str = item.data_ocorrencia.isoformat()
+            chave = (regra_pai.id, data_excecao_str)
+            db_agendamento = ocorrencias_criadas.get(chave)
+            if db_agendamento is not None:
+                # Mesma ocorrência repetida no lote: vale o último status
+                db_agendamento.status = item.novo_status
+            else:
+                if regra_pai.exdates:
+                    if data_excecao_str not in regra_pai.exdates:
+                        regra_pai.exdates += f",{data_excecao_str}"
+                else:
+                    regra_pai.exdates = data_excecao_str
+                alterados.add(regra_pai.id)
+
+                duracao = regra_pai.data_hora_fim - regra_pai.data_hora_inicio
+                db_agendamento = Agendamento(
+                    paciente_id=regra_pai.paciente_id,
+                    data_hora_inicio=item.data_ocorrencia,
+                    data_hora_fim=item.data_ocorrencia + duracao,
+                    status=item.novo_status,
+                    rrule=None,
+                    paciente=regra_pai.paciente
+                )
+                db.add(db_agendamento)
+                ocorrencias_criadas[chave] = db_agendamento
+
+        resultado.sucesso = True
+        afetados.append((resultado, db_agendamento))
+
+    try:
+        db.flush()
+        # Serializa antes do commit para não recarregar cada agendamento depois dele
+        for resultado, db_agendamento in afetados:
+            resultado.agendamento = AgendamentoSchema.model_validate(db_agendamento)
+            alterados.add(db_agendamento.id)
+        for agendamento_id in sorted(alterados):
+            registrar_alteracao(db, 'agendamento', agendamento_id)
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        raise HTTPException(status_code=500, detail=f"Erro ao salvar no banco: {e}")
+
+    return resultados
+
 
 # --- Rotas de EVOLUÇÃO ---
 @app.post("/agendamentos/{agendamento_id}/evolucoes", status_code=status.HTTP_201_CREATED)
 def criar_evolucao(agendamento_id: int, evolucao: EvolucaoCreate, db: Session = Depends(get_db)):
+    travar_alteracoes(db)
     db_agendamento = db.query(Agendamento).filter(Agendamento.id == agendamento_id).first()
     if db_agendamento is None:
         raise HTTPException(status_code=404, detail="Agendamento not found")
@@ -423,6 +613,8 @@ def criar_evolucao(agendamento_id: int, evolucao: EvolucaoCreate, db: Session =
         paciente_id=db_agendamento.paciente_id
     )
     db.add(db_evolucao)
+    db.flush()
+    registrar_alteracao(db, 'evolucao', db_evolucao.id)
     db.commit()
     return {"detail": "Evolução salva com sucesso"}
 
@@ -457,6 +649,77 @@ def get_dashboard_sessoes(ano: int, mes: int, db: Session = Depends(get_db)):
     
     return resultados
 
+# --- Rota de SINCRONIZAÇÃO ---
+
+# Registros por lote no /sync: tamanho do yield_per e das listas do IN
+# (fica bem abaixo do limite de parâmetros do SQLite)
+TAMANHO_LOTE_SYNC = 500
+
+def gerar_linhas_sync(since: int):
+    # O corpo é gerado enquanto é enviado, então o gerador abre e fecha a própria sessão
+    # em vez de depender de quando o FastAPI encerra o get_db.
+    from sqlalchemy import func
+
+    tipos = {
+        'paciente': (Paciente, PacienteSchema),
+        'agendamento': (Agendamento, AgendamentoSyncSchema),
+        'evolucao': (Evolucao, EvolucaoSyncSchema),
+    }
+
+    db = SessionLocal()
+    try:
+        versao_atual = db.query(func.max(Alteracao.id)).scalar() or 0
+        completo = since <= 0 or since > versao_atual
+
+        versao = versao_atual
+        operacoes = {entidade: {} for entidade in tipos}
+        if not completo:
+            versao = since
+            alteracoes = db.query(Alteracao.id, Alteracao.entidade, Alteracao.entidade_id, Alteracao.operacao).filter(
+                Alteracao.id > since, Alteracao.id <= versao_atual
+            ).order_by(Alteracao.id)
+            # Só a última operação de cada registro importa
+            for alteracao_id, entidade, entidade_id, operacao in alteracoes:
+                versao = alteracao_id
+                if entidade in operacoes:
+                    operacoes[entidade][entidade_id] = operacao
+
+        yield json.dumps({"versao": versao, "completo": completo}, separators=(",", ":")) + "\n"
+
+        for entidade, (modelo, schema) in tipos.items():
+            if completo:
+                registros = db.query(modelo).order_by(modelo.id).yield_per(TAMANHO_LOTE_SYNC)
+            else:
+                ids_upsert = [i for i, op in operacoes[entidade].items() if op == 'upsert']
+                registros = (
+                    registro
+                    for inicio in range(0, len(ids_upsert), TAMANHO_LOTE_SYNC)
+                    for registro in db.query(modelo).filter(modelo.id.in_(ids_upsert[inicio:inicio + TAMANHO_LOTE_SYNC]))
+                )
+
+            enviados = set()
+            for registro in registros:
+                dados = schema.model_validate(registro).model_dump(mode="json")
+                yield json.dumps({"tipo": entidade, "op": "upsert", "dados": dados}, separators=(",", ":")) + "\n"
+                enviados.add(registro.id)
+
+            # Deletes do log e upserts de registros que já não existem mais
+            for entidade_id in operacoes[entidade]:
+                if entidade_id not in enviados:
+                    yield json.dumps({"tipo": entidade, "op": "delete", "id": entidade_id}, separators=(",", ":")) + "\n"
+    finally:
+        db.close()
+
+@app.get("/sync")
+def sincronizar(since: int = 0):
+    # Devolve em NDJSON só o que mudou depois da versão `since` do cliente.
+    # Primeira linha: {"versao": N, "completo": bool}; depois uma linha por registro.
+    # O upsert traz o registro inteiro, com os campos vazios como null. Com since=0, ou uma versão que o
+    # servidor não conhece, devolve a base inteira e o cliente refaz o cache local.
+    # Como travar_alteracoes serializa as escritas no log, todo id <= versao já está
+    # commitado quando a versão é lida, e nenhuma alteração fica para trás.
+    return StreamingResponse(gerar_linhas_sync(since), media_type="application/x-ndjson")
+
 # --- Rota Raiz (Opcional) ---
 
 @app.get("/")